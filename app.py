@@ -3,10 +3,17 @@ import streamlit as st
 import pandas as pd
 from db import get_user_records_df_by_userid, return_book_db, get_books_df
 import os
+import glob
 import time
-from datetime import datetime
-from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import IntegrityError
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 import hashlib
+import hmac
 import warnings
 
 # suppress some openpyxl warnings that may appear when writing Excel
@@ -29,11 +36,57 @@ if not os.path.exists(DATA_FOLDER):
 # -----------------------------
 engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
 
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-65536",
+)
 
-def hash_password(raw: str, salt: str = "smartlib_salt"):
+
+@contextmanager
+def _transaction(conn=None):
+    # join the caller's transaction when one is passed in
+    if conn is not None:
+        yield conn
+    else:
+        with engine.begin() as conn:
+            yield conn
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _record):
+    # runs once per pooled DBAPI connection, not per checkout
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+ph = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+
+def legacy_hash_password(raw: str, salt: str = "smartlib_salt"):
+    # pre-Argon2 scheme; only used to verify and upgrade old rows
     return hashlib.sha256((salt + raw).encode("utf-8")).hexdigest()
 
 
+def check_password(stored, raw):
+    if not stored:
+        return False
+    if stored.startswith("$argon2"):
+        try:
+            return ph.verify(stored, raw)
+        except (VerificationError, InvalidHashError):
+            return False
+    return hmac.compare_digest(stored, legacy_hash_password(raw))
+
+
+def needs_rehash(stored):
+    return not stored.startswith("$argon2") or ph.check_needs_rehash(stored)
+
+
 def init_db():
     with engine.begin() as conn:
         conn.execute(text("""
@@ -50,6 +103,7 @@ def init_db():
             CREATE TABLE IF NOT EXISTS borrowed_records (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user TEXT,
+                user_lower TEXT,
                 title TEXT,
                 borrow_date DATETIME,
                 return_date DATETIME,
@@ -57,6 +111,40 @@ def init_db():
                 fine REAL DEFAULT 0
             )
         """))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_borrowed_borrow_date ON borrowed_records(borrow_date DESC)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_borrowed_user ON borrowed_records(user, borrow_date DESC)"
+        ))
+        # stock lives here; the Excel files in data/ are only an import source
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS library_books (
+                book_key TEXT PRIMARY KEY,
+                source_file TEXT,
+                row_idx INTEGER,
+                book_id TEXT,
+                title TEXT,
+                author TEXT,
+                genre TEXT,
+                isbn TEXT,
+                publisher TEXT,
+                year INTEGER,
+                price REAL,
+                copies_available INTEGER DEFAULT 0,
+                shelf_number TEXT,
+                level TEXT,
+                synced_mtime REAL
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS book_files (
+                source_file TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                row_count INTEGER
+            )
+        """))
 
 
 def fix_borrowed_records_table():
@@ -70,33 +158,92 @@ def fix_borrowed_records_table():
         if "fine" not in col_names:
             conn.execute(text("ALTER TABLE borrowed_records ADD COLUMN fine REAL DEFAULT 0"))
 
+        if "user_lower" not in col_names:
+            conn.execute(text("ALTER TABLE borrowed_records ADD COLUMN user_lower TEXT"))
+        # backfill with Python's str.lower(), the one inserts use: SQLite's
+        # lower() only folds ASCII. Non-ASCII names are redone in case an
+        # older backfill used lower()
+        stale = conn.execute(text("""
+            SELECT id, user, user_lower FROM borrowed_records
+            WHERE user IS NOT NULL AND (user_lower IS NULL OR user GLOB '*[^ -~]*')
+        """)).fetchall()
+        fixes = [{"id": rid, "u": user.lower()} for rid, user, lc in stale if lc != user.lower()]
+        if fixes:
+            conn.execute(text("UPDATE borrowed_records SET user_lower = :u WHERE id = :id"), fixes)
+
+        # superseded by the user_lower indexes below
+        conn.execute(text("DROP INDEX IF EXISTS idx_borrowed_user_lower"))
+        conn.execute(text("DROP INDEX IF EXISTS idx_borrowed_open"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_borrowed_user_lc ON borrowed_records(user_lower)"
+        ))
+
+    ensure_open_loan_index()
+
+
+def ensure_open_loan_index():
+    """Enforce one open loan per user and title; returns False while duplicates block it."""
+    # the has_open_borrow() check alone can race between two tabs
+    with engine.connect() as conn:
+        fallback = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_borrowed_open_lc'"
+        )).first()
+        unique = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_borrowed_open_uq'"
+        )).first()
+    if unique and not fallback:
+        return True
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_borrowed_open_uq
+                ON borrowed_records(user_lower, title) WHERE return_date IS NULL
+            """))
+            conn.execute(text("DROP INDEX IF EXISTS idx_borrowed_open_lc"))
+        return True
+    except IntegrityError:
+        # duplicate open loans from before the index existed; keep a plain
+        # index for lookups and try again next session, once they are returned
+        with engine.begin() as conn:
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_borrowed_open_lc
+                ON borrowed_records(user_lower, title) WHERE return_date IS NULL
+            """))
+        return False
 
 
 def create_admin(email: str = "admin@library.local", password: str = "admin123", name: str = "Admin"):
-    hashed = hash_password(password)
     with engine.begin() as conn:
-        existing = conn.execute(text("SELECT user_id FROM users WHERE email=:email"), {"email": email}).fetchone()
+        existing = conn.execute(text("SELECT user_id, password FROM users WHERE email=:email"), {"email": email}).fetchone()
         if not existing:
             conn.execute(text("""
                 INSERT INTO users (name, email, password, role)
                 VALUES (:name, :email, :password, 'admin')
-            """), {"name": name, "email": email, "password": hashed})
+            """), {"name": name, "email": email, "password": ph.hash(password)})
         else:
+            # only re-hash when the stored hash is stale, Argon2 is deliberately slow
+            stored = existing[1]
+            if not check_password(stored, password) or needs_rehash(stored):
+                stored = ph.hash(password)
             conn.execute(text("""
                 UPDATE users SET password=:password, name=:name, role='admin'
                 WHERE email=:email
-            """), {"password": hashed, "name": name, "email": email})
+            """), {"password": stored, "name": name, "email": email})
 
 
 def verify_user_credentials(email, password):
     if not email or not password:
         return None
-    hashed = hash_password(password)
-    with engine.begin() as conn:
+    with engine.connect() as conn:
         row = conn.execute(text(
-            "SELECT user_id, name, email, role FROM users WHERE email = :e AND password = :p"
-        ), {"e": email.strip(), "p": hashed}).fetchone()
-        if row:
+            "SELECT user_id, name, email, role, password FROM users WHERE email = :e"
+        ), {"e": email.strip()}).fetchone()
+        if row and check_password(row[4], password):
+            # transparently upgrade legacy SHA-256 rows on successful login
+            if needs_rehash(row[4]):
+                conn.execute(text("UPDATE users SET password = :p WHERE user_id = :id"),
+                             {"p": ph.hash(password), "id": row[0]})
+                conn.commit()
             return {"user_id": row[0], "name": row[1], "email": row[2], "role": row[3]}
     return None
 
@@ -104,7 +251,7 @@ def verify_user_credentials(email, password):
 def create_user(name, email, password):
     if not (name and email and password):
         return False, "All fields required."
-    hashed = hash_password(password)
+    hashed = ph.hash(password)
     try:
         with engine.begin() as conn:
             conn.execute(text("""
@@ -120,7 +267,7 @@ def create_user(name, email, password):
 
 
 def get_user_by_email(email):
-    with engine.begin() as conn:
+    with engine.connect() as conn:
         row = conn.execute(text(
             "SELECT user_id, name, email, role FROM users WHERE email = :e"
         ), {"e": email}).fetchone()
@@ -129,82 +276,399 @@ def get_user_by_email(email):
     return None
 
 
+def fix_library_books_table():
+    # sidecars from older suffixes, including ones whose workbook is gone;
+    # nothing reads them any more
+    for old in glob.glob(os.path.join(glob.escape(DATA_FOLDER), "*.xls*.*parquet")):
+        if not old.endswith(SIDECAR_SUFFIX):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    # rows used to be keyed "<file>:<row index>"; move them to the stable
+    # _book_keys() identity in place so current stock is kept
+    with engine.begin() as conn:
+        old = pd.read_sql(text("""
+            SELECT book_key, source_file, book_id, title, author FROM library_books
+            ORDER BY source_file, row_idx
+        """), conn)
+        # size is the file size in bytes; uploads have no file and record
+        # their row count separately
+        cols = [c[1] for c in conn.execute(text("PRAGMA table_info(book_files)"))]
+        if "row_count" not in cols:
+            conn.execute(text("ALTER TABLE book_files ADD COLUMN row_count INTEGER"))
+        conn.execute(text("""
+            UPDATE book_files SET row_count = size, size = NULL
+            WHERE source_file NOT LIKE '%.xlsx' AND source_file NOT LIKE '%.xls'
+              AND row_count IS NULL
+        """))
+        # CSV/Parquet uploads used to be imported without a book_files row
+        conn.execute(text("""
+            INSERT OR IGNORE INTO book_files (source_file, mtime, row_count)
+            SELECT source_file, 0, COUNT(*) FROM library_books
+            WHERE source_file NOT LIKE '%.xlsx' AND source_file NOT LIKE '%.xls'
+            GROUP BY source_file
+        """))
+        # prices synced while rows were float32 were stored widened
+        conn.execute(text(
+            "UPDATE library_books SET price = round(price, 2) WHERE price IS NOT NULL"
+        ))
+        if old.empty:
+            return
+        new_keys = pd.concat([
+            _book_keys(group, file) for file, group in old.groupby("source_file", sort=False)
+        ])
+        changed = old["book_key"] != new_keys.reindex(old.index)
+        if changed.any():
+            conn.execute(
+                text("UPDATE library_books SET book_key = :new WHERE book_key = :old"),
+                [{"new": new, "old": key} for key, new
+                 in zip(old.loc[changed, "book_key"], new_keys.reindex(old.index)[changed])]
+            )
+
+
 # -----------------------------
 # BOOK / FILE HANDLING
 # -----------------------------
-def load_all_books():
-    all_files = [
-    f for f in os.listdir(DATA_FOLDER)
-    if f.lower().endswith((".xlsx", ".xls"))
+CANONICAL_COLS = [
+    "book_id", "title", "author", "genre", "isbn", "publisher",
+    "year", "price", "copies_available", "shelf_number", "level", "source_file"
 ]
 
-    if not all_files:
-        return pd.DataFrame(columns=[
-            "book_id", "title", "author", "genre", "isbn", "publisher",
-            "year", "price", "copies_available", "shelf_number", "level", "source_file"
-        ])
+RENAME_MAP = {
+    "bookid": "book_id", "book_code": "book_id",
+    "book_title": "title", "bookname": "title", "book": "title",
+    "writer": "author", "author_name": "author",
+    "genre_category": "genre", "category": "genre", "type": "genre",
+    "isbn_number": "isbn",
+    "publishing_company": "publisher", "pub": "publisher",
+    "publish_year": "year",
+    "cost": "price", "amount": "price", "book_price": "price",
+    "no_of_copies": "copies_available", "quantity": "copies_available",
+    "stock": "copies_available",
+    "shelf_no": "shelf_number", "rack_no": "shelf_number",
+}
+
+# dtypes of normalized rows that get written to library_books; price stays
+# float64 (rounded to paise) so SQLite stores 90.92, not a widened float32
+DTYPES = {"copies_available": "Int64", "year": "Int64", "price": "float64"}
+
+# dtypes of the frame handed to the UI: narrow numbers, and Arrow-backed
+# strings keep the search/filter .str kernels off Python objects
+BOOK_DTYPES = {
+    "copies_available": "int32[pyarrow]",
+    "year": "Int16",
+    "price": "float32",
+    "title": "string[pyarrow]",
+    "author": "string[pyarrow]",
+    "genre": "string[pyarrow]",
+    "publisher": "string[pyarrow]",
+    "level": "string[pyarrow]",
+    "source_file": "string[pyarrow]",
+}
+
+
+def _list_book_files():
+    """Return (file, path, mtime, size) for every book workbook in DATA_FOLDER."""
+    entries = []
+    for file in os.listdir(DATA_FOLDER):
+        if not file.lower().endswith((".xlsx", ".xls")) or file.startswith("~$"):
+            continue
+        path = os.path.join(DATA_FOLDER, file)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((file, path, stat.st_mtime, stat.st_size))
+    return entries
 
-    df_list = []
 
-    for file in all_files:
-        if file.startswith("~$"):
-            continue
+def _normalize_header(columns):
+    # one pass per header: snake_case it, then a single alias lookup
+    keys = (str(c).strip().lower().replace(" ", "_") for c in columns)
+    return [RENAME_MAP.get(key, key) for key in keys]
 
-        path = os.path.join(DATA_FOLDER, file)
+
+def _read_xlsx_fast(path):
+    # calamine (Rust) streams both .xlsx and legacy .xls without building an
+    # openpyxl cell DOM; openpyxl is only used for writing
+    return pd.read_excel(path, engine="calamine").dropna(how="all")
+
+
+def _read_book_file(path):
+    try:
+        df = _read_xlsx_fast(path)
+    except ImportError:
+        # python-calamine missing: fail loudly instead of skipping every file
+        raise
+    except Exception:
+        return None
+    return _normalize_books(df, os.path.basename(path))
+
+
+# values the narrow UI dtypes in BOOK_DTYPES can hold; anything outside
+# (a full date in the year column, an ISBN in the stock column) is junk
+YEAR_RANGE = (0, 9999)
+MAX_COPIES = 2**31 - 1
+
+
+def _mask_out_of_range(df):
+    """Set year/copies values that don't fit BOOK_DTYPES to NA."""
+    df = df.copy()
+    df["year"] = pd.to_numeric(df["year"], errors="coerce").where(lambda y: y.between(*YEAR_RANGE))
+    df["copies_available"] = pd.to_numeric(df["copies_available"], errors="coerce").where(
+        lambda c: c <= MAX_COPIES
+    )
+    return df
+
+
+def _normalize_books(df, source_file):
+    # also applied here (not only in _read_xlsx_fast) so frames that never
+    # went through a workbook read, e.g. an upload, normalize identically
+    df = df.dropna(how="all")
+    df.columns = _normalize_header(df.columns)
+    # an alias and its canonical name may both be present; keep the first
+    df = df.loc[:, ~df.columns.duplicated()].reindex(columns=CANONICAL_COLS)
+
+    title = df["title"].astype("string").str.strip()
+    keep = (title.fillna("") != "").to_numpy()
+    # positional, so frames with duplicate index labels work too
+    df = df[keep]
+    df["title"] = title[keep].astype(object).to_numpy()
+
+    numeric = df[list(DTYPES)].apply(pd.to_numeric, errors="coerce")
+    numeric = _mask_out_of_range(numeric)
+    numeric["copies_available"] = numeric["copies_available"].fillna(1).clip(lower=0)
+    df[list(DTYPES)] = numeric.round({"copies_available": 0, "year": 0, "price": 2}).astype(DTYPES)
+
+    df["source_file"] = source_file
+    return df
+
+
+# bump the suffix whenever _normalize_books changes its output, so older
+# sidecars are ignored instead of being imported again
+SIDECAR_SUFFIX = ".v3.parquet"
+
+
+# every rewrite of a workbook is a new (path, mtime, size) key; cap the
+# entries so superseded frames are evicted instead of kept for good
+@st.cache_data(max_entries=64, show_spinner=False)
+def _load_one_book(path, mtime, size):
+    # mtime/size are part of the cache key only: rewriting the workbook
+    # changes them, so stale entries are never served.
+    sidecar = path + SIDECAR_SUFFIX
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= mtime:
         try:
-            df = pd.read_excel(path)
+            return pd.read_parquet(sidecar, engine="pyarrow")
         except Exception:
-            continue
+            pass
+
+    df = _read_book_file(path)
+    if df is not None:
+        # already-normalized copy, so the next cold load skips openpyxl
+        try:
+            df.to_parquet(sidecar, engine="pyarrow", compression="zstd")
+        except Exception:
+            pass
+        else:
+            _remove_stale_sidecars(path)
+    return df
+
+
+def _remove_stale_sidecars(path):
+    # "<file>.parquet" (v1) and "<file>.vN.parquet" left by earlier suffixes
+    for old in glob.glob(glob.escape(path) + ".*parquet"):
+        if old != path + SIDECAR_SUFFIX:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def _book_keys(df, source_file, seen=None):
+    """Stable per-file row keys, so stock follows a book when rows move.
+
+    A row is identified by its book_id when it has one, else by its
+    lower-cased title and author; repeats of the same identity get a
+    "#n" suffix in row order. ``seen`` carries the counts across chunks.
+    """
+    num = pd.to_numeric(df["book_id"], errors="coerce")
+    whole = num.where(num % 1 == 0)  # 7.0 from Excel and "7" give the same id
+    ids = df["book_id"].astype("string").str.strip()
+    ids = ids.mask(whole.notna(), whole.astype("Int64").astype("string")).replace("", pd.NA)
+    title = df["title"].astype("string").str.strip().str.lower().fillna("")
+    author = df["author"].astype("string").str.strip().str.lower().fillna("")
+    key = (source_file + ":" + ("id:" + ids).fillna("t:" + title + "|" + author)).astype(object)
+
+    n = key.groupby(key).cumcount()
+    if seen is not None:
+        n += key.map(seen).fillna(0).astype(int)
+        for k, count in key.value_counts().items():
+            seen[k] = seen.get(k, 0) + count
+    return key.where(n == 0, key + "#" + n.astype(str))
+
+
+UPSERT_BOOK_SQL = text("""
+    INSERT INTO library_books (
+        book_key, source_file, row_idx, book_id, title, author, genre, isbn,
+        publisher, year, price, copies_available, shelf_number, level, synced_mtime
+    ) VALUES (
+        :book_key, :source_file, :row_idx, :book_id, :title, :author, :genre, :isbn,
+        :publisher, :year, :price, :copies_available, :shelf_number, :level, :synced_mtime
+    )
+    ON CONFLICT(book_key) DO UPDATE SET
+        book_id = excluded.book_id, title = excluded.title, author = excluded.author,
+        genre = excluded.genre, isbn = excluded.isbn, publisher = excluded.publisher,
+        year = excluded.year, price = excluded.price, shelf_number = excluded.shelf_number,
+        level = excluded.level, synced_mtime = excluded.synced_mtime
+""")
+
+
+def import_book_file(file, path, mtime, size, conn=None):
+    df = _load_one_book(path, mtime, size)
+    if df is None:
+        return
+    df = df.copy()
+    df["row_idx"] = df.index
+    df["book_key"] = _book_keys(df, file)
+    df["synced_mtime"] = mtime
+    rows = df.astype(object).where(df.notna(), None).to_dict("records")
+    with _transaction(conn) as conn:
+        # copies_available is only set on first import; after that the
+        # table is the source of truth for stock
+        if rows:
+            conn.execute(UPSERT_BOOK_SQL, rows)
+        conn.execute(text("""
+            DELETE FROM library_books
+            WHERE source_file = :f AND synced_mtime IS NOT :m
+        """), {"f": file, "m": mtime})
+        conn.execute(text("""
+            INSERT INTO book_files (source_file, mtime, size) VALUES (:f, :m, :s)
+            ON CONFLICT(source_file) DO UPDATE SET mtime = excluded.mtime, size = excluded.size
+        """), {"f": file, "m": mtime, "s": size})
+
+
+def sync_books_from_data_files():
+    """Import new or changed workbooks in DATA_FOLDER and drop deleted ones."""
+    files = _list_book_files()
+    with engine.connect() as conn:
+        known = {f: (m, sz) for f, m, sz in conn.execute(
+            text("SELECT source_file, mtime, size FROM book_files")
+        )}
+    changed = [entry for entry in files if known.get(entry[0]) != (entry[2], entry[3])]
+    # CSV/Parquet uploads are book_files entries with no file on disk;
+    # only workbooks mirror DATA_FOLDER
+    removed = {
+        f for f in set(known) - {entry[0] for entry in files}
+        if f.lower().endswith((".xlsx", ".xls"))
+    }
+    if not changed and not removed:
+        return
+
+    if changed:
+        # parse cold workbooks concurrently (zip inflate and XML parsing
+        # release the GIL); the imports below then hit the warm cache
+        workers = min(8, os.cpu_count() or 1, len(changed))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(lambda entry: _load_one_book(*entry[1:]), changed))
 
-        df.columns = [c.strip().lower().replace(" ", "_") for c in df.columns.astype(str)]
-
-        mapping = {
-            "bookid": "book_id", "book_code": "book_id",
-            "book_title": "title", "bookname": "title", "book": "title",
-            "writer": "author", "author_name": "author",
-            "genre_category": "genre", "category": "genre", "type": "genre",
-            "isbn_number": "isbn",
-            "publishing_company": "publisher", "pub": "publisher",
-            "publish_year": "year",
-            "cost": "price", "amount": "price", "book_price": "price",
-            "no_of_copies": "copies_available", "quantity": "copies_available",
-            "stock": "copies_available",
-            "shelf_no": "shelf_number", "rack_no": "shelf_number",
-        }
-        df.rename(columns=mapping, inplace=True)
-
-        for col in [
-            "book_id", "title", "author", "genre", "isbn", "publisher",
-            "year", "price", "copies_available", "shelf_number", "level"
-        ]:
-            if col not in df.columns:
-                df[col] = None
-
-        df["title"] = df["title"].astype(str).str.strip()
-        df = df[df["title"] != ""]
-
-        df["copies_available"] = (
-            pd.to_numeric(df["copies_available"], errors="coerce")
-            .fillna(1).astype(int).clip(lower=0)
+    with engine.begin() as conn:
+        for file, path, mtime, size in changed:
+            import_book_file(file, path, mtime, size, conn=conn)
+        for file in removed:
+            conn.execute(text("DELETE FROM library_books WHERE source_file = :f"), {"f": file})
+            conn.execute(text("DELETE FROM book_files WHERE source_file = :f"), {"f": file})
+    invalidate_db_caches()
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _load_books_cached(db_mtime):
+    with engine.connect() as conn:
+        df = pd.read_sql(
+            text(f"SELECT book_key, {', '.join(CANONICAL_COLS)} FROM library_books "
+                 "ORDER BY source_file, row_idx"),
+            conn
         )
+    # rows stored before the range checks existed may still hold junk
+    df = _mask_out_of_range(df)
+    df["copies_available"] = df["copies_available"].fillna(0)
+    df = df.astype(BOOK_DTYPES)
+    # lower-cased "title ¦ author" so a search is one contains() scan
+    df["_search"] = (df["title"].fillna("") + " ¦ " + df["author"].fillna("")).str.lower()
+    return df
 
-        df["year"] = pd.to_numeric(df["year"], errors="coerce")
-        df["price"] = pd.to_numeric(df["price"], errors="coerce")
 
-        df["source_file"] = file
+def load_all_books():
+    sync_books_from_data_files()
+    return _load_books_cached(_db_mtime())
 
-        df_list.append(df[[
-            "book_id", "title", "author", "genre", "isbn", "publisher",
-            "year", "price", "copies_available", "shelf_number", "level", "source_file"
-        ]])
 
-    if not df_list:
-        return pd.DataFrame(columns=[
-            "book_id", "title", "author", "genre", "isbn", "publisher",
-            "year", "price", "copies_available", "shelf_number", "level", "source_file"
-        ])
+@st.cache_resource(ttl=30, max_entries=4, show_spinner=False)
+def _title_to_key_cached(db_mtime):
+    # shared read-only dict (cache_resource does not copy it per rerun); for
+    # duplicate titles the first in-stock row wins, else the first row
+    df = _load_books_cached(db_mtime)[["title", "book_key", "copies_available"]].iloc[::-1]
+    in_stock = df["copies_available"] > 0
+    ordered = pd.concat([df[~in_stock], df[in_stock]])
+    return dict(zip(ordered["title"], ordered["book_key"]))
+
+
+def book_key_for_title(title):
+    return _title_to_key_cached(_db_mtime()).get(title)
+
+
+@st.cache_data(ttl=30, max_entries=32, show_spinner=False)
+def _search_books_cached(db_mtime, query):
+    df = _load_books_cached(db_mtime)
+    return df[df["_search"].str.contains(query, regex=False, na=False)]
+
+
+def search_books(query):
+    """Books whose title or author contains ``query`` (case-insensitive)."""
+    return _search_books_cached(_db_mtime(), query.lower())
+
+
+@st.cache_data(ttl=30, max_entries=64, show_spinner=False)
+def _category_books_cached(db_mtime, genre_word, level_word=None):
+    df = _load_books_cached(db_mtime)
+    mask = df["genre"].str.contains(genre_word, case=False, regex=False, na=False)
+    if level_word is not None:
+        mask &= df["level"].str.contains(level_word, case=False, regex=False, na=False)
+    return df.loc[mask, ["title", "author", "copies_available"]]
 
-    return pd.concat(df_list, ignore_index=True)
+
+def category_books(genre_word, level_word=None):
+    """Books whose genre (and level, if given) contains the given word."""
+    return _category_books_cached(_db_mtime(), genre_word, level_word)
+
+
+def invalidate_db_caches():
+    # mtime keys alone can miss two commits inside one timestamp tick on
+    # coarse filesystems; call after any committed write to books/records
+    _load_books_cached.clear()
+    _title_to_key_cached.clear()
+    _search_books_cached.clear()
+    _category_books_cached.clear()
+    _load_records_cached.clear()
+
+
+def take_book_copy(book_key, conn=None):
+    """Atomically take one copy of ``book_key``; False when none are left."""
+    with _transaction(conn) as conn:
+        res = conn.execute(text("""
+            UPDATE library_books SET copies_available = copies_available - 1
+            WHERE book_key = :k AND copies_available > 0
+        """), {"k": book_key})
+        return res.rowcount > 0
+
+
+def return_book_copy(book_key, conn=None):
+    with _transaction(conn) as conn:
+        conn.execute(text("""
+            UPDATE library_books SET copies_available = copies_available + 1
+            WHERE book_key = :k
+        """), {"k": book_key})
 
 
 def save_new_book_file(df, filename=None):
@@ -212,63 +676,215 @@ def save_new_book_file(df, filename=None):
         filename = f"books_{int(time.time())}.xlsx"
     path = os.path.join(DATA_FOLDER, filename)
     df.to_excel(path, index=False, engine="openpyxl")
-    st.success(f"✅ Saved as {filename}")
+    stat = os.stat(path)
+    # convert once on ingest: the sidecar is written after the workbook, so
+    # _load_one_book picks it up and never has to parse the xlsx back
+    try:
+        _normalize_books(df, filename).to_parquet(
+            path + SIDECAR_SUFFIX, engine="pyarrow", compression="zstd"
+        )
+    except Exception:
+        pass
+    import_book_file(filename, path, stat.st_mtime, stat.st_size)
+    return filename
 
 
+def import_book_chunks(chunks, source_file):
+    """Stream CSV/Parquet book rows straight into library_books; returns the row count."""
+    total = 0
+    seen = {}
+    with engine.begin() as conn:
+        for chunk in chunks:
+            # read_csv chunks keep a running index, so row_idx stays unique
+            df = _normalize_books(chunk, source_file)
+            df["row_idx"] = df.index
+            df["book_key"] = _book_keys(df, source_file, seen)
+            df.to_sql("library_books", conn, if_exists="append", index=False,
+                      method="multi", chunksize=1000)
+            total += len(df)
+        # registered like a workbook so the source is listed in book_files
+        conn.execute(text("""
+            INSERT INTO book_files (source_file, mtime, row_count) VALUES (:f, :m, :n)
+            ON CONFLICT(source_file) DO UPDATE SET mtime = excluded.mtime, row_count = excluded.row_count
+        """), {"f": source_file, "m": time.time(), "n": total})
+    return total
+
+
+def upload_source_name(ext, file_id):
+    # the file_id part keeps two uploads within one second apart
+    return f"books_{int(time.time())}_{file_id[:8]}{ext}"
+
+
+def list_book_sources():
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(
+            text("SELECT source_file FROM book_files ORDER BY source_file")
+        )]
+
+
+def open_loans_for_source(source_file):
+    # loans are recorded by title, so count the unreturned ones for any
+    # title this list provides
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            SELECT COUNT(*) FROM borrowed_records
+            WHERE return_date IS NULL
+              AND title IN (SELECT title FROM library_books WHERE source_file = :f)
+        """), {"f": source_file}).scalar()
+
+
+def remove_book_source(source_file):
+    """Drop an imported book list: its rows, its book_files entry and any file on disk."""
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM library_books WHERE source_file = :f"), {"f": source_file})
+        conn.execute(text("DELETE FROM book_files WHERE source_file = :f"), {"f": source_file})
+    path = os.path.join(DATA_FOLDER, source_file)
+    for leftover in (path, path + SIDECAR_SUFFIX):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    _remove_stale_sidecars(path)
+    invalidate_db_caches()
+
+
+DB_DATETIME_FMT = "%Y-%m-%d %H:%M:%S"
+
 
 def _normalize_dt_for_db(dt):
     if dt is None:
         return None
-    if isinstance(dt, pd.Timestamp):
-        dt_py = dt.to_pydatetime()
-        return dt_py.strftime("%Y-%m-%d %H:%M:%S")
-    if isinstance(dt, datetime):
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
+    # hot path: plain datetime.now() values from the borrow/return handlers
+    if type(dt) is datetime:
+        return dt.strftime(DB_DATETIME_FMT)
     if isinstance(dt, str):
         return dt
+    if dt is pd.NaT:
+        return None
+    if isinstance(dt, datetime):
+        # pd.Timestamp and other datetime subclasses
+        return dt.strftime(DB_DATETIME_FMT)
     try:
-        coerced = pd.to_datetime(dt)
-        return coerced.to_pydatetime().strftime("%Y-%m-%d %H:%M:%S")
+        return pd.to_datetime(dt).strftime(DB_DATETIME_FMT)
     except Exception:
         return None
 
 
-def load_records_from_db():
-    with engine.begin() as conn:
+def _db_mtime():
+    # in WAL mode commits land in the -wal file until a checkpoint
+    stamps = []
+    for path in (DB_FILE, DB_FILE + "-wal"):
         try:
-            rec_df = pd.read_sql("SELECT * FROM borrowed_records", conn)
+            stamps.append(os.path.getmtime(path))
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
 
-            # ✅ Normalize datetime columns
-            for col in ["borrow_date", "return_date", "due"]:
-                if col not in rec_df.columns:
-                    rec_df[col] = pd.NaT
-                else:
-                    rec_df[col] = rec_df[col].replace("", pd.NaT)
-                    rec_df[col] = pd.to_datetime(rec_df[col], errors="coerce")
 
-            # ✅ Ensure fine column
-            if "fine" not in rec_df.columns:
-                rec_df["fine"] = 0
+RECORD_COLUMNS = ["id", "user", "user_lower", "title", "borrow_date", "return_date", "due", "fine"]
+RECORDS_PAGE_SIZE = 500
+
+
+def _normalize_records(rec_df):
+    # ✅ Normalize datetime columns
+    for col in ["borrow_date", "return_date", "due"]:
+        if col not in rec_df.columns:
+            rec_df[col] = pd.NaT
+        else:
+            rec_df[col] = rec_df[col].replace("", pd.NaT)
+            rec_df[col] = pd.to_datetime(rec_df[col], errors="coerce")
+
+    # ✅ Ensure fine column
+    if "fine" not in rec_df.columns:
+        rec_df["fine"] = 0
+
+    return rec_df
+
 
-            return rec_df
+@st.cache_data(ttl=30, show_spinner=False)
+def _load_records_cached(db_mtime, user_lower=None):
+    # db_mtime only keys the cache; every committed write bumps it.
+    with engine.connect() as conn:
+        try:
+            if user_lower is None:
+                rec_df = pd.read_sql("SELECT * FROM borrowed_records", conn)
+            else:
+                rec_df = pd.read_sql_query(
+                    text("SELECT * FROM borrowed_records WHERE user_lower = :u"),
+                    conn, params={"u": user_lower}
+                )
+            return _normalize_records(rec_df)
 
         except Exception:
-            return pd.DataFrame(
-                columns=["id", "user", "title", "borrow_date", "return_date", "due", "fine"]
+            return pd.DataFrame(columns=RECORD_COLUMNS)
+
+
+def load_records_from_db(user_lower=None):
+    """Return borrow records, only those of ``user_lower`` (a lower-cased name) when given."""
+    return _load_records_cached(_db_mtime(), user_lower)
+
+
+def list_record_users():
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(text(
+            "SELECT DISTINCT user FROM borrowed_records WHERE user IS NOT NULL ORDER BY user"
+        ))]
+
+
+# separate statements per filter: an "(:u IS NULL OR user = :u)" clause
+# keeps SQLite from using idx_borrowed_user
+COUNT_RECORDS_SQL = text("SELECT COUNT(*) FROM borrowed_records")
+COUNT_USER_RECORDS_SQL = text("SELECT COUNT(*) FROM borrowed_records WHERE user = :u")
+RECORDS_PAGE_SQL = text("""
+    SELECT * FROM borrowed_records
+    ORDER BY borrow_date DESC
+    LIMIT :lim OFFSET :off
+""")
+USER_RECORDS_PAGE_SQL = text("""
+    SELECT * FROM borrowed_records
+    WHERE user = :u
+    ORDER BY borrow_date DESC
+    LIMIT :lim OFFSET :off
+""")
+
+
+def count_records(user=None):
+    sql = COUNT_RECORDS_SQL if user is None else COUNT_USER_RECORDS_SQL
+    with engine.connect() as conn:
+        return conn.execute(sql, {"u": user}).scalar() or 0
+
+
+def load_records_page(user=None, limit=RECORDS_PAGE_SIZE, offset=0):
+    """Newest-first page of borrow records, optionally for one exact ``user``."""
+    sql = RECORDS_PAGE_SQL if user is None else USER_RECORDS_PAGE_SQL
+    with engine.connect() as conn:
+        try:
+            rec_df = pd.read_sql_query(
+                sql, conn, params={"u": user, "lim": int(limit), "off": int(offset)}
             )
+        except Exception:
+            return pd.DataFrame(columns=RECORD_COLUMNS)
+    return _normalize_records(rec_df)
+
 
+def has_open_borrow(user_lower, title, conn=None):
+    with _transaction(conn) as conn:
+        return conn.execute(text("""
+            SELECT 1 FROM borrowed_records
+            WHERE user_lower = :u AND title = :t AND return_date IS NULL
+            LIMIT 1
+        """), {"u": user_lower, "t": title}).first() is not None
 
 
-def save_record_to_db(user, title, borrow_date=None, return_date=None, due_date=None, fine=0):
+def save_record_to_db(user, title, borrow_date=None, return_date=None, due_date=None, fine=0, conn=None):
     borrow_date_db = _normalize_dt_for_db(borrow_date or datetime.now())
     return_date_db = _normalize_dt_for_db(return_date)
     due_date_db = _normalize_dt_for_db(due_date)
-    with engine.begin() as conn:
+    with _transaction(conn) as conn:
         conn.execute(text("""
-            INSERT INTO borrowed_records (user, title, borrow_date, return_date, due, fine)
-            VALUES (:user, :title, :borrow_date, :return_date, :due, :fine)
+            INSERT INTO borrowed_records (user, user_lower, title, borrow_date, return_date, due, fine)
+            VALUES (:user, :user_lower, :title, :borrow_date, :return_date, :due, :fine)
         """), {
             "user": user,
+            "user_lower": user.lower(),
             "title": title,
             "borrow_date": borrow_date_db,
             "return_date": return_date_db,
@@ -277,56 +893,26 @@ def save_record_to_db(user, title, borrow_date=None, return_date=None, due_date=
         })
 
 
-def update_return_in_db(record_id, return_date, fine):
+def update_return_in_db(record_id, return_date, fine, conn=None):
+    """Close an open loan in one UPDATE; False if it was already returned."""
     return_date_db = _normalize_dt_for_db(return_date)
 
-    with engine.begin() as conn:
-        conn.execute(
+    with _transaction(conn) as conn:
+        res = conn.execute(
             text("""
                 UPDATE borrowed_records
                 SET return_date = :return_date,
                     fine = :fine
-                WHERE id = :id
+                WHERE id = :id AND return_date IS NULL
             """),
             {
                 "return_date": return_date_db,
                 "fine": fine,
-                "id": record_id
+                # numpy ints would be bound as BLOBs and match nothing
+                "id": int(record_id)
             }
         )
-
-
-def find_book_in_data_files(title):
-    files = [f for f in os.listdir(DATA_FOLDER) if f.lower().endswith((".xlsx", ".xls"))]
-    for file in files:
-        path = os.path.join(DATA_FOLDER, file)
-        try:
-            df = pd.read_excel(path)
-        except Exception:
-            continue
-        cols_low = [c.strip().lower().replace(" ", "_") for c in df.columns.astype(str)]
-        df.columns = cols_low
-        if "title" not in df.columns:
-            continue
-        matches = df[df["title"].astype(str).str.lower() == str(title).lower()]
-        if not matches.empty:
-            idx = matches.index[0]
-            return path, df, idx
-    return None, None, None
-
-def safe_fmt(dt):
-    if pd.isna(dt):
-        return "-"
-    if isinstance(dt, (pd.Timestamp, datetime)):
-        return dt.strftime("%d-%b-%Y")
-    try:
-        coerced = pd.to_datetime(dt, errors="coerce")
-        if pd.isna(coerced):
-            return "-"
-        else:
-            return coerced.strftime("%d-%b-%Y")
-    except Exception:
-        return "-"
+        return res.rowcount > 0
 
 
 # -----------------------------
@@ -338,6 +924,8 @@ if "user" not in st.session_state:
     st.session_state.user = None
 if "user_id" not in st.session_state:
     st.session_state.user_id = None
+if "user_lower" not in st.session_state:
+    st.session_state.user_lower = None
 
 # Keep admin sidebar fields persistent keys to avoid collisions
 if "admin_email" not in st.session_state:
@@ -348,9 +936,33 @@ if "admin_pass" not in st.session_state:
 # -----------------------------
 # INIT DB + ADMIN
 # -----------------------------
-init_db()
-fix_borrowed_records_table()   # 🔧 IMPORTANT LINE
-create_admin(email="shanker@gmail.com", password="Isha@2004", name="Shanker")
+# Bump when init_db()/fix_borrowed_records_table() change, so existing
+# installs re-run the bootstrap once.
+DB_SCHEMA_VERSION = "5"
+BOOTSTRAP_SENTINEL = DB_FILE + ".bootstrapped"
+
+
+def _db_bootstrapped():
+    try:
+        with open(BOOTSTRAP_SENTINEL) as f:
+            return f.read().strip() == DB_SCHEMA_VERSION and os.path.exists(DB_FILE)
+    except OSError:
+        return False
+
+
+# the DDL is a no-op after the first run, so skip it per session and,
+# via the sentinel file, for every later session of this database
+if "_db_ready" not in st.session_state:
+    if not _db_bootstrapped():
+        init_db()
+        fix_borrowed_records_table()   # 🔧 IMPORTANT LINE
+        fix_library_books_table()
+        create_admin(email="shanker@gmail.com", password="Isha@2004", name="Shanker")
+        with open(BOOTSTRAP_SENTINEL, "w") as f:
+            f.write(DB_SCHEMA_VERSION)
+    # cheap when the unique index is in place; otherwise retried each session
+    st.session_state._open_loans_unique = ensure_open_loan_index()
+    st.session_state._db_ready = True
 
 
 # -----------------------------
@@ -370,6 +982,7 @@ if st.session_state.page == "login":
         if user and user["role"] == "admin":
             st.session_state.page = "admin"
             st.session_state.user = user["name"]
+            st.session_state.user_lower = user["name"].lower()
             st.session_state.user_id = user["user_id"]
             st.sidebar.success(f"✅ Welcome, {user['name']} (Admin)")
             time.sleep(1)
@@ -392,6 +1005,7 @@ if st.session_state.page == "login":
                 if user:
                     st.session_state.page = "user"
                     st.session_state.user = user["name"]
+                    st.session_state.user_lower = user["name"].lower()
                     st.session_state.user_id = user["user_id"]
                     st.rerun()
                 else:
@@ -428,24 +1042,30 @@ elif st.session_state.page == "admin":
     if st.sidebar.button("Logout"):
         st.session_state.page = "login"
         st.session_state.user = None
+        st.session_state.user_lower = None
         st.session_state.user_id = None
         time.sleep(1)
         st.rerun()
 
+    if not st.session_state.get("_open_loans_unique", True):
+        st.warning("⚠️ Some users have the same book borrowed twice. Return the extra "
+                   "copies so the library can block duplicate loans again.")
+
     tab1, tab2, tab3 = st.tabs(["📊 All User Records", "📚 Manage Books", "👥 Registered Users"])
 
     # Tab1: All user records
     with tab1:
         st.subheader("📋 Borrow / Return Records of All Users")
-        borrowed_records = load_records_from_db()
-        if not borrowed_records.empty:
-            users = borrowed_records["user"].dropna().unique().tolist()
+        users = list_record_users()
+        if users:
             selected_user = st.selectbox("Select User (or All)", ["All"] + users)
-            if selected_user != "All":
-                view_df = borrowed_records[borrowed_records["user"] == selected_user]
-            else:
-                view_df = borrowed_records
-            st.dataframe(view_df.sort_values(by="borrow_date", ascending=False), use_container_width=True)
+            user_filter = None if selected_user == "All" else selected_user
+            pages = max(1, -(-count_records(user_filter) // RECORDS_PAGE_SIZE))
+            page = 1
+            if pages > 1:
+                page = st.number_input("Page", min_value=1, max_value=pages, value=1, step=1)
+            view_df = load_records_page(user_filter, offset=(page - 1) * RECORDS_PAGE_SIZE)
+            st.dataframe(view_df.drop(columns=["user_lower"], errors="ignore"), use_container_width=True)
         else:
             st.info("No borrow/return records found yet.")
 
@@ -459,21 +1079,66 @@ elif st.session_state.page == "admin":
             st.info("No books found in 'data' folder.")
 
         st.markdown("---")
-        st.subheader("📤 Upload New Book Excel (Admin)")
-        uploaded_file = st.file_uploader("Upload Excel with book list", type=["xlsx", "xls"], key="admin_upload")
-        if uploaded_file:
+        st.subheader("📤 Upload New Book List (Admin)")
+        flash = st.session_state.pop("upload_flash", None)
+        if flash:
+            st.success(flash)
+        uploaded_file = st.file_uploader(
+            "Upload Excel, CSV or Parquet with book list",
+            type=["xlsx", "xls", "csv", "parquet"],
+            key="admin_upload"
+        )
+        # the uploader keeps its file across reruns; import each upload once
+        if uploaded_file and st.session_state.get("last_upload_id") != uploaded_file.file_id:
+            ext = os.path.splitext(uploaded_file.name)[1].lower()
             try:
-                df = pd.read_excel(uploaded_file)
-                save_new_book_file(df)
-                # after upload, re-run to show updated list
-                st.experimental_rerun()
+                if ext == ".csv":
+                    # large catalogs stream in chunks; everything is read as
+                    # text and coerced once by the normal book normalization
+                    source = upload_source_name(".csv", uploaded_file.file_id)
+                    count = import_book_chunks(
+                        pd.read_csv(uploaded_file, chunksize=50_000, dtype=str), source
+                    )
+                    msg = f"✅ Imported {count} books from {uploaded_file.name}"
+                elif ext == ".parquet":
+                    source = upload_source_name(".parquet", uploaded_file.file_id)
+                    # the stored index (often duplicated after a concat) is
+                    # meaningless here; row_idx must be a plain position
+                    count = import_book_chunks(
+                        [pd.read_parquet(uploaded_file).reset_index(drop=True)], source
+                    )
+                    msg = f"✅ Imported {count} books from {uploaded_file.name}"
+                else:
+                    df = pd.read_excel(uploaded_file, engine="calamine")
+                    saved = save_new_book_file(df, upload_source_name(".xlsx", uploaded_file.file_id))
+                    msg = f"✅ Saved as {saved}"
             except Exception as e:
                 st.error(f"Error reading uploaded file: {e}")
+            else:
+                invalidate_db_caches()
+                st.session_state.last_upload_id = uploaded_file.file_id
+                st.session_state.upload_flash = msg
+                # after upload, re-run to show updated list
+                st.rerun()
+
+        sources = list_book_sources()
+        if sources:
+            st.markdown("---")
+            st.subheader("🗑️ Remove a Book List")
+            to_remove = st.selectbox("Imported list", sources, key="remove_source")
+            open_loans = open_loans_for_source(to_remove)
+            if open_loans:
+                st.warning(f"⚠️ {open_loans} borrowed book(s) from {to_remove} are not returned yet.")
+            confirm = st.checkbox(f"I understand this deletes {to_remove} from the data folder", key="confirm_remove_source")
+            if st.button("Remove", key="btn_remove_source", disabled=not confirm):
+                remove_book_source(to_remove)
+                st.session_state.upload_flash = f"✅ Removed {to_remove}"
+                st.rerun()
 
     # Tab3: Registered users
     with tab3:
         st.subheader("👥 Registered Users")
-        with engine.begin() as conn:
+        with engine.connect() as conn:
             try:
                 users_df = pd.read_sql("SELECT user_id, name, email, role, registered_at FROM users", conn)
             except Exception:
@@ -495,9 +1160,17 @@ elif st.session_state.page == "user":
     if st.sidebar.button("Logout"):
         st.session_state.page = "login"
         st.session_state.user = None
+        st.session_state.user_lower = None
         st.session_state.user_id = None
         st.rerun()
 
+    # fetched once per rerun and shared by every tab below
+    books_df = load_all_books()
+    # sessions that logged in before user_lower existed
+    if st.session_state.user_lower is None:
+        st.session_state.user_lower = str(st.session_state.user).lower()
+    borrowed_records = load_records_from_db(user_lower=st.session_state.user_lower)
+
     # Define tabs properly
     tab1, tab2, tab3, tab4 = st.tabs([
         "🔍 Search Books",
@@ -509,26 +1182,28 @@ elif st.session_state.page == "user":
     # TAB 1: Search
     with tab1:
         st.subheader("🔍 Search Books")
-        books_df = load_all_books()
         if not books_df.empty:
-            search = st.text_input("Search by Title or Author", key="search_input_user")
+            # the query is only applied on Enter / "Search", and the result is
+            # cached, so other reruns of the page don't rescan the catalog
+            with st.form("search_form"):
+                search = st.text_input("Search by Title or Author", key="search_input_user")
+                st.form_submit_button("Search")
             if search:
-                filtered = books_df[
-                    books_df["title"].astype(str).str.contains(search, case=False, na=False)
-                    | books_df["author"].astype(str).str.contains(search, case=False, na=False)
-                ]
+                filtered = search_books(search)
             else:
                 filtered = books_df
-            st.dataframe(filtered, use_container_width=True)
+            st.dataframe(filtered.drop(columns=["book_key", "_search"]), use_container_width=True)
         else:
             st.info("📂 Upload books in 'data' folder first (admin only).")
 
     # TAB 2: Borrow / Return
     with tab2:
-        st.subheader("📘 Borrow a Book")
+        # result of a borrow/return from the previous run, shown after st.rerun()
+        flash = st.session_state.pop("borrow_flash", None)
+        if flash:
+            st.success(flash)
 
-        borrowed_records = load_records_from_db()
-        books_df = load_all_books()
+        st.subheader("📘 Borrow a Book")
 
         if books_df.empty:
             st.info("No books available for borrowing.")
@@ -546,55 +1221,50 @@ elif st.session_state.page == "user":
 
                 if st.button("Borrow Book", key="btn_borrow"):
 
-                    # 🔒 Prevent duplicate borrowing
-                    existing = borrowed_records[
-                        (borrowed_records["user"].fillna("").str.lower() == st.session_state.user.lower()) &
-                        (borrowed_records["title"] == selected_book) &
-                        (borrowed_records["return_date"].isna())
-                    ]
-
-                    if not existing.empty:
+                    now = datetime.now()
+                    due_date = now + timedelta(days=7)
+
+                    book_key = book_key_for_title(selected_book)
+
+                    # ✅ Check, take a copy and save the loan in one transaction
+                    try:
+                        with engine.begin() as conn:
+                            # 🔒 Prevent duplicate borrowing
+                            duplicate = has_open_borrow(st.session_state.user_lower, selected_book, conn=conn)
+                            borrowed = not duplicate and take_book_copy(book_key, conn=conn)
+                            if borrowed:
+                                save_record_to_db(
+                                    user=st.session_state.user,
+                                    title=selected_book,
+                                    borrow_date=now,
+                                    due_date=due_date,
+                                    conn=conn
+                                )
+                    except IntegrityError:
+                        # another tab opened the same loan after our check; the
+                        # unique open-loan index rejected it and the copy taken
+                        # above was rolled back with it
+                        duplicate, borrowed = True, False
+                    if borrowed:
+                        invalidate_db_caches()
+
+                    if duplicate:
                         st.warning("⚠️ You have already borrowed this book.")
+                    elif not borrowed:
+                        st.warning("⚠️ No copies of this book are left.")
                     else:
-                        now = datetime.now()
-                        due_date = now + pd.Timedelta(days=7)
-
-                        # ✅ Save to DB
-                        save_record_to_db(
-                            user=st.session_state.user,
-                            title=selected_book,
-                            borrow_date=now,
-                            due_date=due_date
-                        )
-
-                        # 📉 Update Excel stock
-                        path, df, idx = find_book_in_data_files(selected_book)
-                        if df is not None and path is not None:
-                            df.columns = [c.strip().lower().replace(" ", "_") for c in df.columns.astype(str)]
-
-                            if "copies_available" not in df.columns:
-                                df["copies_available"] = 1
-
-                            current = pd.to_numeric(df.loc[idx, "copies_available"], errors="coerce")
-                            current = int(current) if not pd.isna(current) else 1
-
-                            df.loc[idx, "copies_available"] = max(0, current - 1)
-                            df.to_excel(path, index=False, engine="openpyxl")
-
-                        st.success(
+                        st.session_state.borrow_flash = (
                             f"✅ Borrowed **'{selected_book}'** successfully!\n\n"
                             f"📅 Borrowed On: {now.strftime('%d-%b-%Y %I:%M %p')}\n"
                             f"📅 Due Date: **{due_date.strftime('%d-%b-%Y')}**"
                         )
+                        st.rerun()
         st.markdown("---")
         st.subheader("📕 Return a Book")
 
-        borrowed_records = load_records_from_db()
-
         # 🔍 Filter current user's unreturned books
         user_borrows = borrowed_records[
-            (borrowed_records["user"].fillna("").str.lower() == st.session_state.user.lower()) &
-            (borrowed_records["return_date"].isna())
+            borrowed_records["return_date"].isna()
         ] if not borrowed_records.empty else pd.DataFrame()
 
         if user_borrows.empty:
@@ -631,80 +1301,60 @@ elif st.session_state.page == "user":
             # 🔘 Return button
             if st.button("Return Book", key="btn_return"):
 
-                # ✅ Update return info
-                update_return_in_db(
-                    record_id=rec["id"],
-                    return_date=today,
-                    fine=fine
-                )
-
-                # 📈 Update book stock (Excel)
-                path, df, idx = find_book_in_data_files(return_choice)
-
-                if df is not None and path is not None:
-                    df.columns = [c.strip().lower().replace(" ", "_") for c in df.columns.astype(str)]
-
-                    if "copies_available" not in df.columns:
-                        df["copies_available"] = 0
-
-                    current = pd.to_numeric(df.loc[idx, "copies_available"], errors="coerce")
-                    current = int(current) if not pd.isna(current) else 0
-                    df.loc[idx, "copies_available"] = current + 1
-
-                    df.to_excel(path, index=False, engine="openpyxl")
-
-                # 🎉 Success message
-                st.success(
-                    f"""
-                    ✅ **Book Returned Successfully!**
-
-                    📘 **Title:** {return_choice}
-                    📅 **Borrowed On:** {borrow_date.strftime('%d-%b-%Y')}
-                    📅 **Returned On:** {today.strftime('%d-%b-%Y')}
-                    💰 **Fine Paid:** ₹{fine}
-                    """
-                )
-
-                st.rerun()
+                book_key = book_key_for_title(return_choice)
+
+                # ✅ Update return info and put the copy back together
+                with engine.begin() as conn:
+                    # a second click/tab finds the loan closed and must not
+                    # put another copy back
+                    returned = update_return_in_db(
+                        record_id=rec["id"],
+                        return_date=today,
+                        fine=fine,
+                        conn=conn
+                    )
+                    if returned and book_key is not None:
+                        return_book_copy(book_key, conn=conn)
+                invalidate_db_caches()
+
+                if not returned:
+                    st.warning("⚠️ This book has already been returned.")
+                else:
+                    # 🎉 Success message
+                    st.session_state.borrow_flash = (
+                        f"""
+                        ✅ **Book Returned Successfully!**
+
+                        📘 **Title:** {return_choice}
+                        📅 **Borrowed On:** {borrow_date.strftime('%d-%b-%Y')}
+                        📅 **Returned On:** {today.strftime('%d-%b-%Y')}
+                        💰 **Fine Paid:** ₹{fine}
+                        """
+                    )
+                    st.rerun()
 
 
     # TAB 3: Your Records
     with tab3:
         st.subheader("📊 Your Borrow / Return History")
-        borrowed_records = load_records_from_db()
-        if not borrowed_records.empty:
-            # protect against missing columns
-            if "user" not in borrowed_records.columns:
-                borrowed_records["user"] = ""
-            user_records = borrowed_records[borrowed_records["user"].fillna("").str.lower() == str(st.session_state.user).lower()]
-        else:
-            user_records = pd.DataFrame()
+        user_records = borrowed_records
 
         if not user_records.empty:
-            # Format dates for display while avoiding errors
-            # Format dates for display while avoiding errors
-            def fmt(dt):
-                try:
-                    return pd.to_datetime(dt, errors="coerce").strftime("%d-%b-%Y")
-                except Exception:
-                    return ""
-            user_records = user_records.copy()
-            user_records["borrow_date"] = user_records["borrow_date"].apply(safe_fmt)
-            user_records["return_date"] = user_records["return_date"].apply(safe_fmt)
-            user_records["due"] = user_records["due"].apply(safe_fmt)
-            # Display dates safely using your function
-            st.write(f"Borrowed On: {safe_fmt(borrow_date)}")
-            st.write(f"Due Date: {safe_fmt(due_date)}")
-            st.write(f"Returned On: {safe_fmt(return_date)}")
-
-            st.dataframe(user_records.sort_values(by="borrow_date", ascending=False), use_container_width=True)
+            # sort on the real datetimes, then format each column in one pass
+            user_records = user_records.sort_values(by="borrow_date", ascending=False)
+            for col in ["borrow_date", "return_date", "due"]:
+                user_records[col] = (
+                    pd.to_datetime(user_records[col], errors="coerce")
+                    .dt.strftime("%d-%b-%Y").fillna("-")
+                )
+
+            st.dataframe(user_records.drop(columns=["user_lower"], errors="ignore"), use_container_width=True)
         else:
             st.info("No borrow/return records found.")
 
     # TAB 4: Book Categories
     with tab4:
         st.subheader("🗂️ Explore Book Categories")
-        books_df = load_all_books()
         if books_df.empty:
             st.info("📂 No books found in the system.")
         else:
@@ -721,12 +1371,13 @@ elif st.session_state.page == "user":
             }
 
             cols = st.columns(3)
-            clicked_cat = None
             i = 0
             for cat in categories.keys():
                 if cols[i % 3].button(cat, key=f"cat_{cat.replace(' ', '_')}"):
-                    clicked_cat = cat
+                    st.session_state.clicked_cat = cat
                 i += 1
+            # remembered so the detail selectboxes below survive their own reruns
+            clicked_cat = st.session_state.get("clicked_cat")
 
             if clicked_cat:
                 st.markdown("---")
@@ -735,19 +1386,25 @@ elif st.session_state.page == "user":
                 if clicked_cat == "Moral Stories":
                     candidates = [f for f in os.listdir(DATA_FOLDER) if "moral" in f.lower() and f.lower().endswith((".xlsx", ".xls"))]
                     if candidates:
-                        stories_df = pd.read_excel(os.path.join(DATA_FOLDER, candidates[0]))
+                        stories_df = _read_xlsx_fast(os.path.join(DATA_FOLDER, candidates[0]))
                         stories_df.columns = [c.strip().title() for c in stories_df.columns.astype(str)]
-                        for idx, row in stories_df.iterrows():
-                            with st.expander(f"{row.get('Title', 'Untitled')}"):
-                                st.write(row.get('Story', ''))
-                                st.markdown(f"**Moral:** {row.get('Moral', '')}")
+                        stories_df = stories_df.reindex(columns=["Title", "Story", "Moral"])
+                        titles = stories_df["Title"].fillna("Untitled").astype(str).tolist()
+                        st.dataframe(stories_df[["Title", "Moral"]], use_container_width=True, hide_index=True)
+                        if titles:
+                            pos = st.selectbox("Read story…", range(len(titles)),
+                                               format_func=titles.__getitem__, key="moral_detail")
+                            row = stories_df.iloc[pos]
+                            with st.expander(titles[pos], expanded=True):
+                                st.write(row["Story"] if pd.notna(row["Story"]) else "")
+                                st.markdown(f"**Moral:** {row['Moral'] if pd.notna(row['Moral']) else ''}")
                     else:
                         st.info("No moral stories found. Please ask admin to upload a file with 'moral' in its name.")
 
                 elif clicked_cat == "Historical Books":
                     candidates = [f for f in os.listdir(DATA_FOLDER) if "histor" in f.lower() and f.lower().endswith((".xlsx", ".xls"))]
                     if candidates:
-                        hist_df = pd.read_excel(os.path.join(DATA_FOLDER, candidates[0]))
+                        hist_df = _read_xlsx_fast(os.path.join(DATA_FOLDER, candidates[0]))
                         cols_low = [c.strip().lower().replace(" ", "_") for c in hist_df.columns.astype(str)]
                         hist_df.columns = cols_low
                         expected = ["book_id", "title", "author", "publisher", "year", "price", "copies_available", "shelf_number", "level"]
@@ -755,8 +1412,13 @@ elif st.session_state.page == "user":
                             if col not in hist_df.columns:
                                 hist_df[col] = None
                         hist_df["copies_available"] = pd.to_numeric(hist_df["copies_available"], errors="coerce").fillna(1).astype(int)
-                        for _, row in hist_df.iterrows():
-                            with st.expander(row["title"] if pd.notna(row["title"]) else "Untitled"):
+                        st.dataframe(hist_df[expected], use_container_width=True, hide_index=True)
+                        titles = hist_df["title"].fillna("Untitled").astype(str).tolist()
+                        if titles:
+                            pos = st.selectbox("View details for…", range(len(titles)),
+                                               format_func=titles.__getitem__, key="hist_detail")
+                            row = hist_df.iloc[pos]
+                            with st.expander(titles[pos], expanded=True):
                                 st.markdown(f"**Book ID:** {row['book_id']}")
                                 st.markdown(f"**Book Title:** {row['title']}")
                                 st.markdown(f"**Author:** {row['author']}")
@@ -774,27 +1436,21 @@ elif st.session_state.page == "user":
                     subcats = categories[clicked_cat]
                     # attempt to find books by genre containing the main category word
                     keyword = clicked_cat.split()[0]  # naive
-                    if "genre" in books_df.columns:
-                        cat_books = books_df[books_df["genre"].astype(str).str.contains(keyword, case=False, na=False)]
-                    else:
-                        cat_books = pd.DataFrame()
 
                     if subcats:
                         for sub in subcats:
                             st.markdown(f"#### 🔹 {sub}")
-                            if "level" in cat_books.columns:
-                                sub_books = cat_books[cat_books["level"].astype(str).str.contains(sub.split()[0], case=False, na=False)]
-                            else:
-                                sub_books = pd.DataFrame()
+                            sub_books = category_books(keyword, sub.split()[0])
                             if not sub_books.empty:
                                 st.write(f"**Total Books:** {len(sub_books)}")
-                                st.dataframe(sub_books[["title", "author", "copies_available"]], use_container_width=True)
+                                st.dataframe(sub_books, use_container_width=True)
                             else:
                                 st.info(f"No books found in '{sub}' section.")
                     else:
+                        cat_books = category_books(keyword)
                         if not cat_books.empty:
                             st.write(f"**Total Books:** {len(cat_books)}")
-                            st.dataframe(cat_books[["title", "author", "copies_available"]], use_container_width=True)
+                            st.dataframe(cat_books, use_container_width=True)
                         else:
                             st.info("No books found in this category.")
 
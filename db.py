@@ -1,7 +1,11 @@
 # db.py
 import os
 import hashlib
+import hmac
+from contextlib import contextmanager
 import pandas as pd
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from sqlalchemy import create_engine, text
 
 # -----------------------------
@@ -19,14 +23,48 @@ if not os.path.exists(DATA_FOLDER):
 engine = create_engine(DB_URL, echo=False, future=True)
 
 
+@contextmanager
+def _transaction(conn=None):
+    """Join the caller's connection when one is passed in, else run in a fresh transaction."""
+    if conn is not None:
+        yield conn
+    else:
+        with engine.begin() as conn:
+            yield conn
+
+
 # =============================
-# PASSWORD HASH HELPER
+# PASSWORD HASH HELPERS
 # =============================
+_ph = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+
 def _hash_password(password: str) -> str:
-    """Return SHA-256 hash of a password."""
+    """Return an Argon2id hash of a password."""
+    return _ph.hash(password)
+
+
+def _legacy_hash_password(password: str) -> str:
+    """Return the old unsalted SHA-256 hash (only used to upgrade old rows)."""
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
 
+def _check_password(stored: str, password: str) -> bool:
+    """Check a password against an Argon2 or legacy SHA-256 hash."""
+    if not stored:
+        return False
+    if stored.startswith("$argon2"):
+        try:
+            return _ph.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return hmac.compare_digest(stored, _legacy_hash_password(password))
+
+
+def _needs_rehash(stored: str) -> bool:
+    return not stored.startswith("$argon2") or _ph.check_needs_rehash(stored)
+
+
 # =============================
 # INITIALIZATION
 # =============================
@@ -67,13 +105,22 @@ def init_db():
             );
         """))
 
+        # users.email is covered by its UNIQUE index; these back the
+        # per-user, per-book and open-loan lookups
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_br_user ON borrow_records(user_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_br_book ON borrow_records(book_id)"))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_br_open ON borrow_records(user_id, book_id)
+            WHERE return_date IS NULL
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_books_title ON books(title)"))
+
 
 def create_admin(email: str = "shanker@gmail.com", password: str = "Isha@2004", name: str = "Shanker"):
     """Create or update the admin account."""
-    hashed = _hash_password(password)
     with engine.begin() as conn:
         existing = conn.execute(
-            text("SELECT user_id FROM users WHERE email=:email"),
+            text("SELECT user_id, password FROM users WHERE email=:email"),
             {"email": email}
         ).fetchone()
 
@@ -83,9 +130,16 @@ def create_admin(email: str = "shanker@gmail.com", password: str = "Isha@2004",
                     INSERT INTO users (name, email, password, role)
                     VALUES (:name, :email, :password, 'admin')
                 """),
-                {"name": name, "email": email, "password": hashed}
+                {"name": name, "email": email, "password": _hash_password(password)}
             )
         else:
+            # keep the stored hash when it already matches; Argon2 is
+            # deliberately slow and hashing differs on every call
+            stored = existing[1]
+            if _check_password(stored, password) and not _needs_rehash(stored):
+                hashed = stored
+            else:
+                hashed = _hash_password(password)
             conn.execute(
                 text("""
                     UPDATE users
@@ -99,18 +153,18 @@ def create_admin(email: str = "shanker@gmail.com", password: str = "Isha@2004",
 # =============================
 # USER FUNCTIONS
 # =============================
-def register_user(name: str, email: str, password: str, role: str = "user"):
+def register_user(name: str, email: str, password: str, role: str = "user", conn=None):
     """Register a new user account."""
     hashed = _hash_password(password)
-    with engine.begin() as conn:
+    with _transaction(conn) as conn:
         conn.execute(text("""
             INSERT INTO users (name, email, password, role)
             VALUES (:name, :email, :password, :role)
         """), {"name": name, "email": email, "password": hashed, "role": role})
 
 
-def get_user_by_email(email: str):
-    with engine.begin() as conn:
+def get_user_by_email(email: str, conn=None):
+    with _transaction(conn) as conn:
         result = conn.execute(
             text("SELECT * FROM users WHERE email=:email"),
             {"email": email}
@@ -118,24 +172,35 @@ def get_user_by_email(email: str):
         return result.mappings().fetchone()
 
 
-def verify_user_credentials(email: str, password: str):
+def verify_user_credentials(email: str, password: str, conn=None):
     """Verify user credentials and return user record if valid."""
-    hashed = _hash_password(password)
-    with engine.begin() as conn:
+    with _transaction(conn) as conn:
         result = conn.execute(
             text("""
-                SELECT user_id, name, email, role
+                SELECT user_id, name, email, role, password
                 FROM users
-                WHERE email=:email AND password=:password
+                WHERE email=:email
             """),
-            {"email": email, "password": hashed}
+            {"email": email}
         ).fetchone()
 
-        return dict(result._mapping) if result else None
+        if not result or not _check_password(result.password, password):
+            return None
+
+        # lazily migrate legacy SHA-256 rows on successful login
+        if _needs_rehash(result.password):
+            conn.execute(
+                text("UPDATE users SET password=:password WHERE user_id=:user_id"),
+                {"password": _hash_password(password), "user_id": result.user_id}
+            )
 
+        user = dict(result._mapping)
+        user.pop("password")
+        return user
 
-def list_users_df():
-    with engine.begin() as conn:
+
+def list_users_df(conn=None):
+    with _transaction(conn) as conn:
         df = pd.read_sql(
             text("SELECT user_id, name, email, role, registered_at FROM users"),
             conn
@@ -146,83 +211,85 @@ def list_users_df():
 # =============================
 # BOOK FUNCTIONS
 # =============================
-def add_book(title: str, author: str = None, price: float = 0.0, copies: int = 0):
-    with engine.begin() as conn:
+def add_book(title: str, author: str = None, price: float = 0.0, copies: int = 0, conn=None):
+    with _transaction(conn) as conn:
         conn.execute(text("""
             INSERT INTO books (title, author, price, copies)
             VALUES (:title, :author, :price, :copies)
         """), {"title": title, "author": author, "price": price, "copies": copies})
 
 
-def update_book_copies(book_id: int, new_copies: int):
-    with engine.begin() as conn:
+def update_book_copies(book_id: int, new_copies: int, conn=None):
+    with _transaction(conn) as conn:
         conn.execute(text("""
             UPDATE books SET copies=:copies WHERE book_id=:book_id
         """), {"copies": new_copies, "book_id": book_id})
 
 
-def get_books_df():
-    with engine.begin() as conn:
-        return pd.read_sql(text("SELECT * FROM books"), conn)
+# integer columns only: the frame is also exported, and a float32 price
+# would be written out as 90.91999816894531 (copies can be NULL in older
+# databases, hence the nullable Int32)
+BOOK_DTYPES = {"book_id": "int32", "copies": "Int32"}
+
+
+def get_books_df(conn=None):
+    with _transaction(conn) as conn:
+        df = pd.read_sql(text("SELECT * FROM books"), conn)
+    return df.astype({c: t for c, t in BOOK_DTYPES.items() if c in df.columns})
 
 
 # =============================
 # BORROW / RETURN FUNCTIONS
 # =============================
-def borrow_book_db(user_id: int, book_id: int) -> bool:
+def borrow_book_db(user_id: int, book_id: int, conn=None) -> bool:
     """Create borrow record and decrement copies."""
-    with engine.begin() as conn:
-        res = conn.execute(
-            text("SELECT copies FROM books WHERE book_id=:book_id"),
-            {"book_id": book_id}
-        ).fetchone()
-
-        if not res or res[0] <= 0:
+    with _transaction(conn) as conn:
+        # check-and-decrement in one statement, so two borrowers can't
+        # both take the last copy
+        res = conn.execute(text("""
+            UPDATE books SET copies=copies-1
+            WHERE book_id=:bid AND copies>0
+            RETURNING book_id
+        """), {"bid": book_id}).fetchone()
+
+        if not res:
             return False
 
         conn.execute(text("""
             INSERT INTO borrow_records (user_id, book_id)
             VALUES (:uid, :bid)
         """), {"uid": user_id, "bid": book_id})
-
-        conn.execute(
-            text("UPDATE books SET copies=copies-1 WHERE book_id=:book_id"),
-            {"book_id": book_id}
-        )
         return True
 
-def return_book_db(user_id: int, book_id: int):
-    with engine.begin() as conn:
+def return_book_db(user_id: int, book_id: int, conn=None):
+    with _transaction(conn) as conn:
+        # close the latest open loan and price it (7 free days) in SQL;
+        # borrow_date and 'now' are both UTC
         record = conn.execute(text("""
-            SELECT record_id, borrow_date
-            FROM borrow_records
-            WHERE user_id=:uid AND book_id=:bid AND return_date IS NULL
-            ORDER BY borrow_date DESC LIMIT 1
+            UPDATE borrow_records
+            SET return_date=CURRENT_TIMESTAMP,
+                fine=MAX(0, CAST(julianday('now') - julianday(borrow_date) AS INTEGER) - 7)
+            WHERE record_id=(
+                SELECT record_id
+                FROM borrow_records
+                WHERE user_id=:uid AND book_id=:bid AND return_date IS NULL
+                ORDER BY borrow_date DESC LIMIT 1
+            )
+            RETURNING fine
         """), {"uid": user_id, "bid": book_id}).fetchone()
 
         if not record:
             return None
 
-        rid, borrow_date = record
-        borrow_ts = pd.to_datetime(borrow_date)
-        days = (pd.Timestamp.now() - borrow_ts).days
-        fine = max(0, (days - 7))
-
-        conn.execute(text("""
-            UPDATE borrow_records
-            SET return_date=CURRENT_TIMESTAMP, fine=:fine
-            WHERE record_id=:rid
-        """), {"fine": fine, "rid": rid})
-
         conn.execute(
             text("UPDATE books SET copies=copies+1 WHERE book_id=:bid"),
             {"bid": book_id}
         )
 
-        return fine
+        return record[0]
 
-def get_user_records_df_by_userid(user_id: int):
-    with engine.begin() as conn:
+def get_user_records_df_by_userid(user_id: int, conn=None):
+    with _transaction(conn) as conn:
         df = pd.read_sql(text("""
             SELECT br.record_id, b.title, b.author,
                 br.borrow_date, br.return_date, br.fine
@@ -234,8 +301,8 @@ def get_user_records_df_by_userid(user_id: int):
     return df
 
 
-def get_all_borrow_records_df():
-    with engine.begin() as conn:
+def get_all_borrow_records_df(conn=None):
+    with _transaction(conn) as conn:
         df = pd.read_sql(text("""
             SELECT br.record_id, u.name AS user_name, u.email AS user_email,
                 b.title, b.book_id, br.borrow_date, br.return_date, br.fine
@@ -250,44 +317,42 @@ def get_all_borrow_records_df():
 # =============================
 # ADMIN DASHBOARD
 # =============================
-def get_admin_stats():
-    with engine.begin() as conn:
-        users = conn.execute(text("SELECT COUNT(*) FROM users WHERE role='user'")).scalar() or 0
-        books = conn.execute(text("SELECT COUNT(*) FROM books")).scalar() or 0
-        borrowed = conn.execute(text("SELECT COUNT(*) FROM borrow_records WHERE return_date IS NULL")).scalar() or 0
-        fine = conn.execute(text("SELECT SUM(fine) FROM borrow_records")).scalar() or 0
-
-    return {
-        "total_users": users,
-        "total_books": books,
-        "borrowed_books": borrowed,
-        "total_fine_collected": fine
-    }
-
-
-def get_top_borrowed_books(limit: int = 5):
-    with engine.begin() as conn:
-        return pd.read_sql(text(f"""
+def get_admin_stats(conn=None):
+    with _transaction(conn) as conn:
+        row = conn.execute(text("""
+            SELECT
+                (SELECT COUNT(*) FROM users WHERE role='user') AS total_users,
+                (SELECT COUNT(*) FROM books) AS total_books,
+                (SELECT COUNT(*) FROM borrow_records WHERE return_date IS NULL) AS borrowed_books,
+                (SELECT COALESCE(SUM(fine), 0) FROM borrow_records) AS total_fine_collected
+        """)).one()
+
+    return dict(row._mapping)
+
+
+def get_top_borrowed_books(limit: int = 5, conn=None):
+    with _transaction(conn) as conn:
+        return pd.read_sql(text("""
             SELECT b.title, COUNT(*) AS borrow_count
             FROM borrow_records br
             JOIN books b ON br.book_id=b.book_id
             GROUP BY b.book_id
             ORDER BY borrow_count DESC
-            LIMIT {limit}
-        """), conn)
+            LIMIT :lim
+        """), conn, params={"lim": int(limit)})
 
 
-def get_recent_borrow_activity(limit: int = 10):
-    with engine.begin() as conn:
-        return pd.read_sql(text(f"""
+def get_recent_borrow_activity(limit: int = 10, conn=None):
+    with _transaction(conn) as conn:
+        return pd.read_sql(text("""
             SELECT u.name AS user_name, b.title, br.borrow_date,
                 br.return_date, br.fine
             FROM borrow_records br
             JOIN users u ON br.user_id=u.user_id
             JOIN books b ON br.book_id=b.book_id
             ORDER BY br.borrow_date DESC
-            LIMIT {limit}
-        """), conn)
+            LIMIT :lim
+        """), conn, params={"lim": int(limit)})
 
 
 # =============================
@@ -297,25 +362,23 @@ def import_books_from_excel(filepath: str):
     if not os.path.exists(filepath):
         raise FileNotFoundError(filepath)
 
-    df = pd.read_excel(filepath)
+    df = pd.read_excel(filepath, engine="calamine")
     df.columns = [c.strip().lower().replace(" ", "_") for c in df.columns]
 
     for col in ["title", "author", "price", "copies"]:
         if col not in df.columns:
             df[col] = None
 
+    df = df[["title", "author", "price", "copies"]].astype({"title": "string", "author": "string"})
+    # title is NOT NULL; blank rows used to be stored as the text "nan"
+    df = df[df["title"].str.strip().fillna("") != ""]
+    df["price"] = pd.to_numeric(df["price"], errors="coerce").fillna(0.0)
+    df["copies"] = pd.to_numeric(df["copies"], errors="coerce").fillna(0).astype("int64")
+
     with engine.begin() as conn:
         conn.execute(text("DELETE FROM books"))
-        for _, r in df.iterrows():
-            conn.execute(text("""
-                INSERT INTO books (title, author, price, copies)
-                VALUES (:title, :author, :price, :copies)
-            """), {
-                "title": str(r["title"]),
-                "author": str(r["author"]),
-                "price": float(r["price"] or 0),
-                "copies": int(r["copies"] or 0)
-            })
+        df.to_sql("books", con=conn, if_exists="append", index=False,
+                  method="multi", chunksize=1000)
 
 
 def export_books_to_excel(filepath: str):
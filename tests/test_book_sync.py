@@ -0,0 +1,89 @@
+"""Stock kept in library_books must survive edits to the source workbook.
+
+Run with:  python -m unittest discover tests
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BookSyncTest(unittest.TestCase):
+    def setUp(self):
+        # app.py keeps library.db and data/ next to itself, so run a copy
+        self.work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work, ignore_errors=True)
+        for name in ("app.py", "db.py"):
+            shutil.copy(os.path.join(REPO, name), self.work)
+        os.makedirs(os.path.join(self.work, "data"))
+        self.book_file = os.path.join(self.work, "data", "books.xlsx")
+
+    def write_books(self, rows, columns=("title", "author", "stock")):
+        pd.DataFrame(rows, columns=list(columns)).to_excel(self.book_file, index=False)
+
+    def user_app(self):
+        at = AppTest.from_file(os.path.join(self.work, "app.py"), default_timeout=60)
+        at.session_state.page = "user"
+        at.session_state.user = "Bob"
+        return at
+
+    def run_app(self, at):
+        at.run()
+        self.assertFalse(at.exception, [e.value for e in at.exception])
+        return at
+
+    def stock(self):
+        with sqlite3.connect(os.path.join(self.work, "library.db")) as conn:
+            return dict(conn.execute("SELECT title, copies_available FROM library_books"))
+
+    def test_row_insert_keeps_stock_with_its_book(self):
+        self.write_books([("A", "x", 5), ("B", "y", 1), ("C", "z", 0)])
+        at = self.run_app(self.user_app())
+
+        at.selectbox(key="borrow_select_book").set_value("B")
+        at.button(key="btn_borrow").click()
+        self.run_app(at)
+        self.assertEqual(self.stock(), {"A": 5, "B": 0, "C": 0})
+
+        # a new row at the top shifts every row index by one
+        self.write_books([("NEW", "w", 2), ("A", "x", 5), ("B", "y", 1), ("C", "z", 0)])
+        self.run_app(at)
+        self.assertEqual(self.stock(), {"NEW": 2, "A": 5, "B": 0, "C": 0})
+
+    def test_out_of_range_year_and_stock_are_dropped(self):
+        # a full date typed into the year column, an ISBN in the stock one
+        self.write_books(
+            [("A", "x", 2, 20010101), ("B", "y", 9780306406157, 1999)],
+            columns=("title", "author", "stock", "publish_year"),
+        )
+        self.run_app(self.user_app())
+        with sqlite3.connect(os.path.join(self.work, "library.db")) as conn:
+            rows = dict((t, (c, y)) for t, c, y in conn.execute(
+                "SELECT title, copies_available, year FROM library_books"
+            ))
+        self.assertEqual(rows, {"A": (2, None), "B": (1, 1999)})
+
+    def test_junk_already_in_library_books_still_renders(self):
+        self.write_books([("A", "x", 2)])
+        self.run_app(self.user_app())
+        with sqlite3.connect(os.path.join(self.work, "library.db")) as conn:
+            conn.execute("UPDATE library_books SET year = 20010101, copies_available = 9780306406157")
+        self.run_app(self.user_app())
+
+    def test_superseded_sidecars_are_removed(self):
+        self.write_books([("A", "x", 2)])
+        data = os.path.dirname(self.book_file)
+        for name in ("books.xlsx.parquet", "books.xlsx.v2.parquet", "gone.xlsx.parquet"):
+            open(os.path.join(data, name), "w").close()
+        self.run_app(self.user_app())
+        self.assertEqual(sorted(os.listdir(data)), ["books.xlsx", "books.xlsx.v3.parquet"])
+
+
+if __name__ == "__main__":
+    unittest.main()